@@ -42,6 +42,9 @@ warning = logger.warning
 error = logger.error
 exception = logger.exception
 
+# Check once if debug logging is on, so hot paths can skip it entirely
+debug_enabled = logger.isEnabledFor(logging.DEBUG)
+
 # CHECK INPUT
 
 # Get the input filename
@@ -60,7 +63,7 @@ argp.add_argument('--xml_format',
 args = argp.parse_args()
 
 # Check if we have a directory 
-debug(f"Using save path {args.save_path}")
+debug("Using save path %s", args.save_path)
 save_dir = pathlib.Path(args.save_path)
 if not save_dir.exists():
     error(f"{save_dir} does not exist")
@@ -71,83 +74,70 @@ if not save_dir.is_dir():
 
 # Fully resolve the path
 save_dir = save_dir.resolve()
-debug(f"Using save directory name {save_dir.name}")
+debug("Using save directory name %s", save_dir.name)
 
 # Our directory should have a file whose name is the same as the save
 # directory.  We should also have a "SaveGameInfo" file.
-found_savegameinfo = False
-save_file: Union[pathlib.Path, None] = None
-for f in save_dir.iterdir():
-    debug(f"Checking file {f.name}")
-    if f.name == 'SaveGameInfo' and f.is_file() is True:
-        debug('Found SaveGameInfo file')
-
-        found_savegameinfo = True
-    elif f.name == save_dir.name and f.is_file() is True:
-        debug('Found save file')
-        save_file = f
-if not found_savegameinfo:
+savegameinfo_file = save_dir / 'SaveGameInfo'
+save_file = save_dir / save_dir.name
+if not savegameinfo_file.is_file():
     error("Your directory does not look like a Stardew Valley save.  It should have a 'SaveGameInfo' file.")
     sys.exit(2)
-if save_file is None:
+if not save_file.is_file():
     error(f"Your directory does not look like a Stardew Valley save.  It should have a '{save_dir.name}' file.")
     sys.exit(2)
 
+# We keep the original save, with ".orig" appended to its name, and write the
+# new save with ".new" appended.  Make sure we won't clobber either one.
+orig_file = save_file.with_name(save_file.name + '.orig')
+new_file = save_file.with_name(save_file.name + '.new')
+for f in (orig_file, new_file):
+    if f.exists():
+        error(f"{f} already exists.  Move it somewhere safe, and try again.")
+        sys.exit(2)
+
 # We found our save!
-debug(f"Using save file {save_file}")
+debug("Using save file %s", save_file)
 
 # READ XML
 
-# Register namespaces
-ElementTree.register_namespace('xsi', 'http://www.w3.org/2001/XMLSchema-instance')
-ElementTree.register_namespace('xsd', 'http://www.w3.org/2001/XMLSchema')
-
 # Make a support function to find a child element
 def xml_find_one_child(
     element: ElementTree._Element,
     name: str,
     attrib: Optional[Tuple[str, str]] = None,
 ) -> ElementTree._Element:
+    if debug_enabled:
+        if attrib is None:
+            debug("Searching for <%s> in <%s>", name, element.tag)
+        else:
+            debug("Searching for <%s %s=%s> in <%s>", name, attrib[0], attrib[1], element.tag)
+
+    # Let lxml filter the children by tag, then check attributes (if any).
+    # Namespaced attribute names are given in "{uri}name" form.
     if attrib is None:
-        debug(f"Searching for <{name}> in <{element.tag}>")
+        matches = element.iterchildren(tag=name)
     else:
-        debug(f"Searching for <{name} {attrib[0]}={attrib[1]}> in <{element.tag}>")
-    match: Optional[ElementTree._Element] = None
-    for child in element:
-        if child.tag == name:
-            # Do we have attributes to check for?
-            if attrib is None:
-                # Check if we already found a match.
-                if match is not None:
-                    raise KeyError(f"Found multiple <{name}> in the {element.tag}")
-                else:
-                    debug('No attribute check needed.  Found match!')
-                    match = child
-                    break
-            else:
-                debug('Found potential match.  Checking attributes.')
-                if attrib[0] in child.attrib:
-                    if child.attrib[attrib[0]] == attrib[1]:
-                        # Check if we already found a match.
-                        if match is not None:
-                            raise KeyError(f"Found multiple <{name}> in the {element.tag}")
-                        else:
-                            debug('Found match with attributes!')
-                            match = child
-                            break
-                    else:
-                        debug('Found attribute, but value does not match.')
-                else:
-                    debug('Attribute not found.  Skipping.')
+        matches = (
+            child for child in element.iterchildren(tag=name)
+            if child.get(attrib[0]) == attrib[1]
+        )
+    match = next(matches, None)
+    if match is not None and next(matches, None) is not None:
+        raise KeyError(f"Found multiple <{name}> in the {element.tag}")
     if match is None:
         raise KeyError(f"Could not find a <{name}> in the {element.tag}")
     else:
-        debug(f'Found: {match.tag} {[e.tag for e in match]}')
+        if debug_enabled:
+            debug('Found: %s %s', match.tag, [e.tag for e in match])
         return match
 
 # Set parser configuration
 xml_parser = ElementTree.XMLParser(
     remove_blank_text=True, # Cleans up human-readable XML
+    collect_ids=False, # We never look anything up by xml:id
+    resolve_entities=False,
+    huge_tree=False,
 )
 
 # Now, start reading!
@@ -171,10 +161,7 @@ try:
     if player_name_val is None:
         error('Player has no name!')
         sys.exit(3)
-    if isinstance(player_name_val, bytes):
-        player_name = player_name_val.decode('utf-8')
-    else:
-        player_name = player_name_val
+    player_name = player_name_val
 except KeyError:
     exception('Could not find the player!')
     sys.exit(3)
@@ -196,32 +183,20 @@ except KeyError:
     sys.exit(3)
 
 # Look up who is in each cabin.
+# An empty cabin has a farmhand with no name.
 debug('Checking cabin occupancy')
-farmhand_names: List[Union[str, None]] = list()
-i = 0
-while (i<len(farmhands)):
-    farmhand = farmhands[i]
-    try:
-        farmhand_name_val = xml_find_one_child(farmhand, 'name').text
-        if farmhand_name_val is None:
-            error('Found a farmhand with no name!')
-            sys.exit(3)
-        if isinstance(farmhand_name_val, bytes):
-            farmhand_names.append(farmhand_name_val.decode('utf-8'))
-        else:
-            farmhand_names.append(farmhand_name_val)
-    except KeyError:
-        farmhand_names.append(None)
-    i = i + 1
+farmhand_name_xpath = ElementTree.XPath('name/text()')
+farmhand_names: List[Union[str, None]] = [
+    (farmhand_name_xpath(farmhand) or [None])[0]
+    for farmhand in farmhands
+]
 
 # SELECT PLAYER
 
 # Show the player and cabin occupant names
 print(f"Found {len(farmhands)} farmhands!")
 print(f" Player: {player_name}")
-i = 0
-for farmhand_name in farmhand_names:
-    i = i + 1
+for i, farmhand_name in enumerate(farmhand_names, 1):
     if farmhand_name is None:
         continue
     else:
@@ -304,12 +279,6 @@ if do_continue == False:
 
 # Continue!!!
 
-# * Remove the current player (player) from the root element (game_root)
-# * Remove the farmhand (target_farmhand) from the target indoors (target_indoors)
-debug('Step: Remove player and farmhand')
-game_root.remove(player)
-farmhands.remove(target_farmhand)
-
 # * Rename the current player (player) from "<player>" to "<farmhand>"
 # * Rename the current farmhand (target_farmhand) from "<farmhand>" to "<player>"
 debug('Step: Change tags')
@@ -321,36 +290,72 @@ target_farmhand.tag = 'player'
 debug('Step: Swap home locations')
 
 # Get the home locations
+homelocation_xpath = ElementTree.XPath('homeLocation')
 try:
-    player_homelocation = xml_find_one_child(player, 'homeLocation')
-    target_farmhand_homelocation = xml_find_one_child(target_farmhand, 'homeLocation')
-except KeyError:
+    player_homelocation = homelocation_xpath(player)[0]
+    target_farmhand_homelocation = homelocation_xpath(target_farmhand)[0]
+except IndexError:
     exception('Player or farmhand is missing a homeLocation!')
     sys.exit(3)
 
 # Do the swap!
-player_homelocation_text = player_homelocation.text
-player_homelocation.text = target_farmhand_homelocation.text
-target_farmhand_homelocation.text = player_homelocation_text
+player_homelocation.text, target_farmhand_homelocation.text = (
+    target_farmhand_homelocation.text,
+    player_homelocation.text,
+)
 
-# * Add the old player (player) to the target indoors (target_indoors), at the end.
-# * Add the new player (target_farmhand) to the root element, at the start
-debug('Step: Insert back into tree')
-farmhands.append(player)
-game_root.insert(0, target_farmhand)
+# * Put the old player (player) into the farmhand's place in <farmhands>.
+#   This also takes the old player out of the root element (game_root).
+# * Put the new player (target_farmhand) into the old player's place.
+debug('Step: Swap places in tree')
+player_i = game_root.index(player)
+farmhands[target_farmhand_i] = player
+game_root.insert(player_i, target_farmhand)
 
 # WRITE XML
 
-# Append ".orig" to the current file name
-orig_file = save_file.with_name(save_file.name + '.orig')
-save_file.rename(orig_file)
-
-# Write out the new XML to the original path
-game_tree.write(
-    str(save_file),
-    encoding='utf-8',
-    pretty_print=args.xml_format,
-)
+# We write the new XML next to the save file, and only move it into place once
+# it has been completely written out.  That way, a failed write leaves the save
+# alone.
+save_path = os.fspath(save_file)
+new_path = os.fspath(new_file)
+orig_path = os.fspath(orig_file)
+
+# Write out the new XML.
+debug('Writing XML')
+new_created = False
+write_done = False
+try:
+    with open(new_path, 'xb') as new_file_out:
+        new_created = True
+        game_tree.write(
+            new_file_out,
+            encoding='utf-8',
+            pretty_print=args.xml_format,
+        )
+        new_file_out.flush()
+        os.fsync(new_file_out.fileno())
+    write_done = True
+except Exception as e:
+    exception('Problem writing save file XML')
+    sys.exit(3)
+finally:
+    # Clean up our partial file after any failure, including a Ctrl-C.
+    if new_created and not write_done:
+        try:
+            os.remove(new_path)
+        except OSError:
+            warning(f"Could not remove the partial save file {new_path}")
+
+# Move the original save aside (we checked earlier that nothing is in the
+# way), then move the new save into place.
+debug('Moving saves into place')
+try:
+    os.replace(save_path, orig_path)
+    os.replace(new_path, save_path)
+except OSError:
+    exception(f"Problem moving the new save into place.  The new save is at {new_path}.")
+    sys.exit(3)
 
 print('All done!')
 sys.exit(0)